@@ -1,15 +1,20 @@
 import os
+import io
 import re
 import json
+import time
 import base64
 import logging
 from urllib.parse import urlparse, quote
 import asyncio
 
-import requests
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 
+from fetcher import SegmentedFetcher
+from terabox import HEADERS, get_terabox_info, get_download_link
+from signing import LINK_SECRET, sign
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -23,27 +28,15 @@ API_HASH = os.getenv("API_HASH")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 BASE_URL = os.getenv("BASE_URL", "http://localhost:5000")  # Your server URL
 
-# Terabox API endpoints
-TERABOX_API_BASE = "https://terabox.hnn.workers.dev/api"
-INFO_ENDPOINT = f"{TERABOX_API_BASE}/get-info-new"
-DOWNLOAD_ENDPOINT = f"{TERABOX_API_BASE}/get-downloadp"
-
-# Headers for requests
-HEADERS = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/144.0.0.0 Safari/537.36 Edg/144.0.0.0',
-    'accept-language': 'en-US,en;q=0.9',
-    'cache-control': 'no-cache',
-    'pragma': 'no-cache',
-    'priority': 'u=1, i',
-    'referer': 'https://terabox.hnn.workers.dev/',
-    'sec-ch-ua': '"Not(A:Brand";v="8", "Chromium";v="144", "Microsoft Edge";v="144"',
-    'sec-ch-ua-mobile': '?0',
-    'sec-ch-ua-platform': '"Windows"',
-    'sec-fetch-dest': 'empty',
-    'sec-fetch-mode': 'cors',
-    'sec-fetch-site': 'same-origin',
-    'sec-fetch-storage-access': 'active'
-}
+# Upload mode: deliver files in Telegram instead of as links
+UPLOAD_MODE = os.getenv("UPLOAD_MODE", "false").lower() == "true"
+FILE_ID_CACHE = os.getenv("FILE_ID_CACHE", "file_ids.json")  # fs_id -> Telegram file_id
+UPLOAD_BUFFER_SIZE = int(os.getenv("UPLOAD_BUFFER_SIZE", 32 * 1024 * 1024))  # Download read-ahead in bytes
+UPLOAD_LIMIT = 2000 * 1024 * 1024  # Telegram limit for bots
+UPLOAD_PART_SIZE = 512 * 1024  # Pyrogram upload part size
+
+if not LINK_SECRET:
+    logger.warning("LINK_SECRET is not set: player links will not be proxied by the server")
 
 # Initialize bot
 app = Client(
@@ -77,64 +70,232 @@ def extract_shorturl(url: str) -> tuple:
         return None, None
 
 
-def get_terabox_info(shorturl: str, pwd: str = '') -> dict:
-    """Get file info from Terabox API"""
+class RemoteFile(io.RawIOBase):
+    """Read-only file object that streams a URL through a segmented fetcher
+
+    Pyrogram uploads from a binary file object by reading it sequentially, so
+    the download runs over several CDN connections in the background while
+    the upload consumes it and nothing is written to disk. Seeks are cheap
+    until the next read; reading from anywhere but the current position
+    starts a new ranged fetch there, which is how a part Telegram reports
+    missing (FilePartMissing) gets sent again.
+    """
+
+    def __init__(self, url: str, size: int, name: str, buffer_size: int = UPLOAD_BUFFER_SIZE):
+        super().__init__()
+        self.size = size
+        self.name = name
+        self.buffer_size = buffer_size
+        self.position = 0  # Next byte the fetcher will return
+        self.offset = 0  # Position reported by tell()
+        self.fetcher = SegmentedFetcher(url, headers=HEADERS, buffer_size=buffer_size)
+        self.started = False
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.offset
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.offset
+        elif whence == io.SEEK_END:
+            offset += self.size
+
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+
+        self.offset = offset
+        return offset
+
+    def _reposition(self):
+        # Continue from tell() with a new fetch if a seek moved it
+        if self.offset == self.position:
+            return
+
+        self.fetcher.close()
+        self.fetcher = SegmentedFetcher(
+            self.fetcher.url,
+            start=self.offset,
+            headers=HEADERS,
+            buffer_size=self.buffer_size
+        )
+        self.position = self.offset
+        self.started = False
+
+    def start(self):
+        """Start downloading in the background"""
+        self._reposition()
+
+        if self.started:
+            return
+
+        self.started = True
+        self.fetcher.open()
+
+        if self.fetcher.size is not None and self.fetcher.size != self.size:
+            raise IOError(f"Expected {self.size} bytes but the server reports {self.fetcher.size}")
+
+    async def wait_ready(self, amount: int = UPLOAD_PART_SIZE):
+        """Wait without blocking the event loop until the next read is buffered"""
+        loop = asyncio.get_running_loop()
+
+        if self.offset >= self.size:
+            return
+
+        if not self.started or self.offset != self.position:
+            await loop.run_in_executor(None, self.start)
+
+        while not self.fetcher.ready(amount):
+            await asyncio.sleep(0.05)
+
+    def readinto(self, target) -> int:
+        if self.offset >= self.size:
+            return 0
+
+        self.start()
+
+        # Pyrogram expects every part but the last to be full
+        view = memoryview(target)
+        filled = 0
+        while filled < len(view):
+            data = self.fetcher.read(len(view) - filled)
+            if not data:
+                break
+            view[filled:filled + len(data)] = data
+            filled += len(data)
+
+        self.position += filled
+        self.offset = self.position
+        return filled
+
+    def close(self):
+        self.fetcher.close()
+        super().close()
+
+
+class FileIdCache:
+    """Persistent mapping of Terabox fs_id to Telegram file_id"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data = {}
+
+        try:
+            with open(path) as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Error loading file_id cache: {e}")
+
+    def get(self, fs_id) -> str:
+        return self.data.get(str(fs_id))
+
+    def set(self, fs_id, file_id: str):
+        self.data[str(fs_id)] = file_id
+        self._save()
+
+    def remove(self, fs_id):
+        if self.data.pop(str(fs_id), None):
+            self._save()
+
+    def _save(self):
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.data, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Error saving file_id cache: {e}")
+
+
+file_id_cache = FileIdCache(FILE_ID_CACHE)
+
+
+async def send_cached_file(client: Client, message: Message, status_msg: Message, fs_id: str,
+                           caption: str) -> bool:
+    """Send a previously uploaded file by its Telegram file_id"""
+    cached_file_id = file_id_cache.get(fs_id)
+
+    if not cached_file_id:
+        return False
+
     try:
-        params = {
-            'shorturl': shorturl,
-            'pwd': pwd
-        }
-        
-        response = requests.get(INFO_ENDPOINT, params=params, headers=HEADERS, timeout=30)
-        response.raise_for_status()
-        
-        data = response.json()
-        
-        if data.get('ok'):
-            return data
-        else:
-            logger.error(f"API returned not ok: {data}")
-            return None
-            
+        await client.send_cached_media(message.chat.id, cached_file_id, caption=caption)
     except Exception as e:
-        logger.error(f"Error getting Terabox info: {e}")
-        return None
+        logger.error(f"Cached file_id failed, uploading again: {e}")
+        file_id_cache.remove(fs_id)
+        return False
+
+    await status_msg.delete()
+    return True
+
+
+async def upload_file(client: Client, message: Message, status_msg: Message, fs_id: str,
+                      filename: str, file_size: int, download_link: str, is_video: bool,
+                      caption: str) -> bool:
+    """Upload the file to Telegram while it downloads, remembering its file_id"""
+    if not file_size or file_size > UPLOAD_LIMIT:
+        return False
+
+    remote_file = RemoteFile(download_link, file_size, filename)
+    last_update = [0.0]
 
+    async def progress(current: int, total: int):
+        # Have the next part buffered before Pyrogram reads it, so the
+        # blocking read never stalls the event loop
+        await remote_file.wait_ready()
+
+        now = time.monotonic()
+        if now - last_update[0] >= 5:
+            last_update[0] = now
+            try:
+                await status_msg.edit_text(
+                    f"📤 **Uploading...** `{current * 100 // total}%`\n\n"
+                    f"`{format_size(current)}` / `{format_size(total)}`"
+                )
+            except Exception:
+                pass
 
-def get_download_link(shareid: int, uk: int, sign: str, timestamp: int, fs_id: str) -> dict:
-    """Get download link from Terabox API"""
     try:
-        payload = {
-            'shareid': shareid,
-            'uk': uk,
-            'sign': sign,
-            'timestamp': timestamp,
-            'fs_id': fs_id
-        }
-        
-        headers = HEADERS.copy()
-        headers['Content-Type'] = 'application/json'
-        headers['origin'] = 'https://terabox.hnn.workers.dev'
-        
-        response = requests.post(
-            DOWNLOAD_ENDPOINT, 
-            json=payload, 
-            headers=headers,
-            timeout=30
-        )
-        response.raise_for_status()
-        
-        data = response.json()
-        
-        if data.get('ok'):
-            return data
+        await status_msg.edit_text("📤 **Uploading to Telegram...**")
+        await remote_file.wait_ready()
+
+        if is_video:
+            sent = await client.send_video(
+                message.chat.id,
+                remote_file,
+                caption=caption,
+                file_name=filename,
+                supports_streaming=True,
+                progress=progress
+            )
+            media = sent.video or sent.document
         else:
-            logger.error(f"Download API returned not ok: {data}")
-            return None
-            
+            sent = await client.send_document(
+                message.chat.id,
+                remote_file,
+                caption=caption,
+                file_name=filename,
+                progress=progress
+            )
+            media = sent.document
     except Exception as e:
-        logger.error(f"Error getting download link: {e}")
-        return None
+        logger.error(f"Error uploading file: {e}")
+        return False
+    finally:
+        remote_file.close()
+
+    if media:
+        file_id_cache.set(fs_id, media.file_id)
+
+    await status_msg.delete()
+    return True
 
 
 def encode_url(url: str) -> str:
@@ -234,6 +395,22 @@ async def handle_message(client: Client, message: Message):
         fs_id = file_info.get('fs_id')
         category = file_info.get('category', '0')
         
+        # Determine if it's a video file
+        is_video = category == '1' or any(
+            filename.lower().endswith(ext) 
+            for ext in ['.mp4', '.mkv', '.avi', '.mov', '.webm', '.flv']
+        )
+        
+        # Create response message
+        response = f"✅ **File Information**\n\n"
+        response += f"📁 **Name:** `{filename}`\n"
+        response += f"📦 **Size:** `{format_size(file_size)}`\n"
+        response += f"🎬 **Type:** {'Video' if is_video else 'File'}\n\n"
+        
+        # Forward a previous upload of the same file instantly
+        if UPLOAD_MODE and await send_cached_file(client, message, status_msg, fs_id, response):
+            return
+        
         await status_msg.edit_text("🔗 **Getting download link...**")
         
         # Get download link
@@ -266,17 +443,20 @@ async def handle_message(client: Client, message: Message):
         # Create player URL
         player_url = f"{BASE_URL}/player?v={encoded_link}&name={quote(filename)}"
         
-        # Determine if it's a video file
-        is_video = category == '1' or any(
-            filename.lower().endswith(ext) 
-            for ext in ['.mp4', '.mkv', '.avi', '.mov', '.webm', '.flv']
-        )
+        # Include the share identity so the server can renew the link
+        player_url += f"&s={quote(shorturl)}&p={quote(pwd)}&f={fs_id}"
         
-        # Create response message
-        response = f"✅ **File Information**\n\n"
-        response += f"📁 **Name:** `{filename}`\n"
-        response += f"📦 **Size:** `{format_size(file_size)}`\n"
-        response += f"🎬 **Type:** {'Video' if is_video else 'File'}\n\n"
+        # Sign the link so the server agrees to proxy it
+        signature = sign(encoded_link, shorturl, pwd, fs_id)
+        if signature:
+            player_url += f"&sig={signature}"
+        
+        # Deliver the file itself in upload mode, falling back to links
+        if UPLOAD_MODE and await upload_file(
+            client, message, status_msg, fs_id, filename, file_size,
+            download_link, is_video, response
+        ):
+            return
         
         # Create inline keyboard
         keyboard = []
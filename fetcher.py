@@ -0,0 +1,463 @@
+import os
+import re
+import math
+import time
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Segmented fetching configuration
+SEGMENT_SIZE = int(os.getenv("FETCH_SEGMENT_SIZE", 4 * 1024 * 1024))  # Bytes per range request
+BUFFER_SIZE = int(os.getenv("FETCH_BUFFER_SIZE", 16 * 1024 * 1024))  # Reassembly ring buffer size
+MIN_CONNECTIONS = int(os.getenv("FETCH_MIN_CONNECTIONS", 1))
+MAX_CONNECTIONS = int(os.getenv("FETCH_MAX_CONNECTIONS", 8))
+INITIAL_CONNECTIONS = int(os.getenv("FETCH_INITIAL_CONNECTIONS", 2))
+ADAPT_INTERVAL = float(os.getenv("FETCH_ADAPT_INTERVAL", 2))  # Seconds between connection count changes
+RETRIES = int(os.getenv("FETCH_RETRIES", 3))  # Retries per segment on connection errors
+MAX_TOTAL_CONNECTIONS = int(os.getenv("FETCH_MAX_TOTAL_CONNECTIONS", 64))  # Across all fetchers
+CHUNK_SIZE = 64 * 1024
+
+# Statuses the CDN answers with once a signed link has expired
+EXPIRED_STATUSES = (403, 410)
+
+# Shared pool so segment requests reuse keep-alive connections to the CDN
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
+session.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
+
+# Every open fetcher holds one slot for its lifetime and every extra
+# connection one more, which bounds both CDN connections and buffer memory
+connection_slots = threading.BoundedSemaphore(MAX_TOTAL_CONNECTIONS)
+
+
+class FetchError(IOError):
+    """Raised when the upstream answers with an unusable response"""
+
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class RingBuffer:
+    """Byte ring buffer that grows on demand up to a fixed capacity"""
+
+    def __init__(self, capacity: int):
+        self.data = bytearray()
+        self.capacity = capacity
+        self.start = 0
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def free(self) -> int:
+        return self.capacity - self.length
+
+    def write(self, data) -> int:
+        """Write as much of `data` as fits and return the number of bytes written"""
+        amount = min(len(data), self.free)
+        if not amount:
+            return 0
+
+        if self.length + amount > len(self.data):
+            self._grow(self.length + amount)
+
+        size = len(self.data)
+        end = (self.start + self.length) % size
+        first = min(amount, size - end)
+        self.data[end:end + first] = data[:first]
+        self.data[:amount - first] = data[first:amount]
+        self.length += amount
+        return amount
+
+    def _grow(self, needed: int):
+        # Unwrap the contents into a larger buffer, at least doubling it
+        size = min(self.capacity, max(needed, 2 * len(self.data), CHUNK_SIZE))
+        contents = self.read(self.length)
+        self.data = bytearray(size)
+        self.data[:len(contents)] = contents
+        self.start = 0
+        self.length = len(contents)
+
+    def read(self, amount: int) -> bytes:
+        """Read up to `amount` bytes"""
+        amount = min(amount, self.length)
+        if not amount:
+            return b''
+        size = len(self.data)
+        first = min(amount, size - self.start)
+        data = bytes(self.data[self.start:self.start + first]) + bytes(self.data[:amount - first])
+        self.start = (self.start + amount) % size
+        self.length -= amount
+        return data
+
+
+class Segment:
+    """A byte range fetched by one connection"""
+
+    def __init__(self, index: int, start: int, end: int = None):
+        self.index = index
+        self.start = start
+        self.end = end  # Inclusive, None for an open-ended body
+        self.position = start  # Next byte to fetch
+        self.pending = bytearray()  # Fetched but not yet in the ring buffer
+        self.done = False
+
+
+class SegmentedFetcher:
+    """Fetch a URL over several pooled connections, one byte range each
+
+    The file is split into fixed-size segments that workers download in
+    parallel. Segments are reassembled in order into a bounded ring buffer
+    that the consumer reads from, and workers may run at most one window of
+    segments ahead of the consumer, so memory stays bounded however slow the
+    consumer is.
+
+    CDNs like Terabox throttle each connection, so the number of connections
+    adapts to measured aggregate throughput: a connection is added every
+    interval, and removed again if it did not raise throughput by at least
+    10%, after which probing pauses for a few intervals.
+
+    Signed links expire, so when a range request is answered with 403 or 410
+    the optional `refresh` callable is given the expired URL and returns a
+    new one, and the range is retried from the same byte offset.
+    """
+
+    def __init__(self, url: str, start: int = 0, end: int = None, headers: dict = None,
+                 segment_size: int = SEGMENT_SIZE, buffer_size: int = BUFFER_SIZE,
+                 min_connections: int = MIN_CONNECTIONS, max_connections: int = MAX_CONNECTIONS,
+                 initial_connections: int = INITIAL_CONNECTIONS, refresh=None):
+        self.url = url
+        self.refresh = refresh
+        self.start = start
+        self.end = end
+        self.headers = headers or {}
+        self.segment_size = segment_size
+        self.min_connections = max(1, min_connections)
+        self.max_connections = max(self.min_connections, max_connections)
+        self.connections = min(max(initial_connections, self.min_connections), self.max_connections)
+
+        # Filled in by open()
+        self.size = None
+        self.ranged = False
+        self.status_code = None
+        self.response_headers = {}
+
+        self.cond = threading.Condition()
+        self.ring = RingBuffer(buffer_size)
+        self.segments = {}
+        self.segment_count = None
+        self.head_index = 0  # Next segment to move into the ring buffer
+        self.next_index = 0  # Next segment to hand to a worker
+        self.workers = 0
+        self.error = None
+        self.closed = False
+        self.holds_slot = False
+
+        # Throughput measurement
+        self.bytes_fetched = 0
+        self.window_started = time.monotonic()
+        self.window_bytes = 0
+        self.previous_rate = None
+        self.previous_workers = 0
+        self.hold = 0
+        self.rate = 0.0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _request(self, start: int, end: int = None) -> requests.Response:
+        headers = self.headers.copy()
+        # Byte ranges refer to the raw body, so never let it be compressed
+        headers['Accept-Encoding'] = 'identity'
+        headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+
+        url = self.url
+        response = session.get(url, headers=headers, stream=True, timeout=30)
+
+        if response.status_code in EXPIRED_STATUSES and self.refresh:
+            response.close()
+            new_url = self.refresh(url)
+            if not new_url:
+                raise FetchError("Link expired and could not be refreshed", response.status_code)
+
+            self.url = new_url
+            response = session.get(new_url, headers=headers, stream=True, timeout=30)
+
+        return response
+
+    def open(self):
+        """Probe the upstream with the first segment and start fetching"""
+        if not connection_slots.acquire(blocking=False):
+            raise FetchError("Too many upstream connections", 503)
+        self.holds_slot = True
+
+        try:
+            self._open()
+        except BaseException:
+            self.close()
+            raise
+
+    def _open(self):
+        first_end = self.start + self.segment_size - 1
+        if self.end is not None:
+            first_end = min(first_end, self.end)
+
+        response = self._request(self.start, first_end)
+        self.status_code = response.status_code
+        self.response_headers = response.headers
+
+        if response.status_code == 206:
+            match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', response.headers.get('Content-Range', ''))
+            total = match.group(3) if match else '*'
+
+            if total == '*':
+                # Unknown size, so a partial body can't be described to the
+                # consumer. Fall back to the whole body over one connection.
+                response.close()
+                response = self._request(0)
+                if response.status_code not in (200, 206):
+                    response.close()
+                    raise FetchError(f"Upstream returned HTTP {response.status_code}", response.status_code)
+                self.start = 0
+                self.end = None
+                self.segment_count = 1
+                first = Segment(0, self.start, self.end)
+            else:
+                self.size = int(total)
+                self.end = self.size - 1 if self.end is None else min(self.end, self.size - 1)
+                self.ranged = True
+                self.segment_count = math.ceil((self.end - self.start + 1) / self.segment_size)
+                first = Segment(0, self.start, min(first_end, self.end))
+        elif response.status_code == 200:
+            # Ranges are not supported, stream the whole body over one connection
+            if response.headers.get('Content-Length'):
+                self.size = int(response.headers['Content-Length'])
+            self.start = 0
+            self.end = self.size - 1 if self.size is not None else None
+            self.segment_count = 1
+            first = Segment(0, self.start, self.end)
+        else:
+            response.close()
+            raise FetchError(f"Upstream returned HTTP {response.status_code}", response.status_code)
+
+        with self.cond:
+            self.segments[0] = first
+            self.next_index = 1
+            self.workers = 1
+            self.window_started = time.monotonic()
+            threading.Thread(target=self._worker, args=(first, response), daemon=True).start()
+
+            for _ in range(self.connections - 1):
+                if not self._spawn():
+                    break
+            self.connections = self.workers
+
+    def _spawn(self) -> bool:
+        """Start another worker if there are segments left and a free connection slot"""
+        # Called with the lock held
+        if self.next_index >= self.segment_count or self.closed:
+            return False
+        if not connection_slots.acquire(blocking=False):
+            return False
+        self.workers += 1
+        threading.Thread(target=self._worker, kwargs={'extra': True}, daemon=True).start()
+        return True
+
+    def _claim(self) -> Segment:
+        """Hand out the next segment, or None when the calling worker should exit"""
+        with self.cond:
+            while True:
+                if (self.closed or self.error or self.next_index >= self.segment_count
+                        or self.workers > self.connections):
+                    self.workers -= 1
+                    self.cond.notify_all()
+                    return None
+
+                # Stay within one window of segments ahead of the consumer
+                if self.next_index < self.head_index + self.connections + 1:
+                    break
+                self.cond.wait()
+
+            index = self.next_index
+            start = self.start + index * self.segment_size
+            segment = Segment(index, start, min(start + self.segment_size - 1, self.end))
+            self.segments[index] = segment
+            self.next_index += 1
+            return segment
+
+    def _worker(self, segment: Segment = None, response: requests.Response = None, extra: bool = False):
+        # The first worker runs on the fetcher's own slot, extra ones took their own
+        try:
+            if segment is None:
+                segment = self._claim()
+
+            while segment is not None:
+                try:
+                    self._fetch(segment, response)
+                except Exception as e:
+                    with self.cond:
+                        if not self.error and not self.closed:
+                            logger.error(f"Error fetching segment {segment.index}: {e}")
+                            self.error = e
+                        self.workers -= 1
+                        self.cond.notify_all()
+                    return
+
+                response = None
+                segment = self._claim()
+        finally:
+            if extra:
+                connection_slots.release()
+
+    def _fetch(self, segment: Segment, response: requests.Response = None):
+        """Download one segment, resuming after connection errors"""
+        attempts = 0
+
+        while segment.end is None or segment.position <= segment.end:
+            try:
+                if response is None:
+                    response = self._request(segment.position, segment.end)
+                    if response.status_code != 206:
+                        raise FetchError(
+                            f"Upstream returned HTTP {response.status_code} for a range request",
+                            response.status_code
+                        )
+
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    with self.cond:
+                        if self.closed:
+                            return
+                        segment.pending += chunk
+                        segment.position += len(chunk)
+                        self.bytes_fetched += len(chunk)
+                        self._flush()
+                        self._adapt()
+
+                        # Other segments are bounded by their length, but the head one
+                        # (and a whole body fetched as one segment) only drains as fast
+                        # as the consumer reads, so don't run ahead of the ring buffer
+                        while (segment.index == self.head_index and len(segment.pending) > CHUNK_SIZE
+                               and not self.closed and not self.error):
+                            self.cond.wait()
+                        if self.closed or self.error:
+                            return
+
+                if segment.end is None:
+                    break
+                if segment.position <= segment.end:
+                    raise IOError(f"Connection closed at byte {segment.position} of {segment.end}")
+            except FetchError:
+                raise
+            except (requests.RequestException, IOError) as e:
+                attempts += 1
+                if attempts > RETRIES:
+                    raise
+                logger.warning(f"Retrying segment {segment.index} from byte {segment.position}: {e}")
+                time.sleep(attempts)
+            finally:
+                if response is not None:
+                    response.close()
+                    response = None
+
+        with self.cond:
+            segment.done = True
+            self._flush()
+
+    def _flush(self):
+        # Move finished data into the ring buffer in order. Called with the lock held.
+        while self.head_index in self.segments:
+            segment = self.segments[self.head_index]
+
+            if segment.pending:
+                written = self.ring.write(segment.pending)
+                del segment.pending[:written]
+                if written:
+                    self.cond.notify_all()
+                if segment.pending:
+                    return
+
+            if not segment.done:
+                return
+
+            del self.segments[self.head_index]
+            self.head_index += 1
+            self.cond.notify_all()
+
+    def _adapt(self):
+        # Adjust the connection count from measured throughput. Called with the lock held.
+        now = time.monotonic()
+        elapsed = now - self.window_started
+        if elapsed < ADAPT_INTERVAL:
+            return
+
+        self.rate = (self.bytes_fetched - self.window_bytes) / elapsed
+        self.window_started = now
+        self.window_bytes = self.bytes_fetched
+
+        # When the consumer is the bottleneck throughput says nothing about the CDN
+        backpressured = self.ring.free == 0 or self.next_index >= self.head_index + self.connections + 1
+        grew = self.previous_rate is not None and self.workers > self.previous_workers
+
+        if grew and self.rate < self.previous_rate * 1.1:
+            # The extra connection did not pay off, drop it and wait before probing again
+            self.connections = max(self.min_connections, self.connections - 1)
+            self.hold = 5
+        elif self.hold:
+            self.hold -= 1
+        elif not backpressured and self.connections < self.max_connections:
+            if self._spawn():
+                self.connections += 1
+
+        self.previous_rate = self.rate
+        self.previous_workers = self.workers
+
+    def _finished(self) -> bool:
+        return self.segment_count is not None and self.head_index >= self.segment_count
+
+    def ready(self, amount: int) -> bool:
+        """Whether a read of `amount` bytes would return without blocking"""
+        with self.cond:
+            return (len(self.ring) >= min(amount, self.ring.capacity)
+                    or self._finished() or self.error is not None)
+
+    def read(self, amount: int = CHUNK_SIZE) -> bytes:
+        """Read up to `amount` bytes in order, returning b'' at the end"""
+        with self.cond:
+            while not len(self.ring) and not self._finished() and not self.error and not self.closed:
+                self.cond.wait()
+
+            if not len(self.ring) and self.error:
+                raise self.error
+
+            data = self.ring.read(amount)
+            self._flush()
+            self.cond.notify_all()
+            return data
+
+    def iter_content(self, chunk_size: int = CHUNK_SIZE):
+        """Yield the body in order"""
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        """Stop all workers and give back the fetcher's connection slot"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+            if self.holds_slot:
+                self.holds_slot = False
+                connection_slots.release()
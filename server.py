@@ -1,9 +1,60 @@
 import os
+import re
+import hmac
+import time
 import base64
+import hashlib
+import functools
+import logging
+import threading
+from collections import OrderedDict
 from urllib.parse import unquote
-from flask import Flask, render_template_string, request, abort
+
+from flask import Flask, Response, render_template_string, request, abort, jsonify, stream_with_context, url_for
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from throttle import Scheduler
+from fetcher import SegmentedFetcher, FetchError
+from terabox import resolve_download_link
+from signing import LINK_SECRET, verify
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
+
+# Bandwidth shaping for /stream
+scheduler = Scheduler()
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+TRUST_PROXY = os.getenv("TRUST_PROXY", "false").lower() == "true"
+
+if not LINK_SECRET:
+    logger.warning("LINK_SECRET is not set: players will stream straight from the CDN, "
+                   "without bandwidth shaping or link renewal")
+
+if TRUST_PROXY:
+    # Take the client address from the hop our reverse proxy appended,
+    # earlier X-Forwarded-For entries are client-controlled
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
+
+# Headers sent to the CDN when proxying
+UPSTREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/144.0.0.0 Safari/537.36 Edg/144.0.0.0',
+}
+
+# Per-stream fetcher limits, kept well below the upload path's since
+# players open and abort many range requests
+STREAM_BUFFER_SIZE = int(os.getenv("STREAM_BUFFER_SIZE", 1024 * 1024))
+STREAM_SEGMENT_SIZE = int(os.getenv("STREAM_SEGMENT_SIZE", 1024 * 1024))
+STREAM_MAX_CONNECTIONS = int(os.getenv("STREAM_MAX_CONNECTIONS", 4))
+
+# Upstream response headers passed through to the client
+PASSTHROUGH_HEADERS = ['Content-Type', 'Last-Modified', 'ETag']
+
+# Share identity behind each player ID, used to re-resolve expired links
+PLAYER_CACHE_SIZE = int(os.getenv("PLAYER_CACHE_SIZE", 10000))
+REFRESH_COOLDOWN = 10  # Seconds before retrying a failed link refresh
+players = OrderedDict()
+players_lock = threading.Lock()
+link_refreshes = {'ok': 0, 'failed': 0}
 
 # HTML template for video player
 PLAYER_TEMPLATE = """
@@ -220,17 +271,43 @@ PLAYER_TEMPLATE = """
 
     <script>
         const video = document.getElementById('videoPlayer');
+        const maxRetries = 3;
+        let retries = 0;
         
-        // Handle video errors
-        video.addEventListener('error', function(e) {
+        // Handle video errors. The server renews expired links, so reload
+        // the stream at the current position a few times before giving up.
+        function handleError(e) {
             console.error('Video error:', e);
+            
+            if (retries < maxRetries) {
+                retries++;
+                const position = video.currentTime;
+                
+                setTimeout(function() {
+                    video.addEventListener('loadedmetadata', function() {
+                        video.currentTime = position;
+                        video.play();
+                    }, { once: true });
+                    video.src = {{ video_url|tojson }};
+                    video.load();
+                }, 1000 * retries);
+                return;
+            }
+            
             const wrapper = document.querySelector('.video-wrapper');
             wrapper.innerHTML = '<div class="error">Failed to load video. The link might have expired. Please try downloading instead.</div>';
+        }
+        
+        video.addEventListener('error', handleError);
+        video.querySelector('source').addEventListener('error', handleError);
+        video.addEventListener('playing', function() {
+            retries = 0;
         });
 
         // Copy link function
         function copyLink() {
-            const url = "{{ video_url }}";
+            // The stream URL is relative to this page
+            const url = new URL({{ video_url|tojson }}, window.location.href).href;
             
             if (navigator.clipboard && navigator.clipboard.writeText) {
                 navigator.clipboard.writeText(url).then(function() {
@@ -364,6 +441,95 @@ def decode_url(encoded_url: str) -> str:
         return None
 
 
+class Player:
+    """Share identity and current download link behind a player ID"""
+
+    def __init__(self, shorturl: str, pwd: str, fs_id: str, url: str):
+        self.shorturl = shorturl
+        self.pwd = pwd
+        self.fs_id = fs_id
+        self.url = url
+        self.failed_at = 0.0
+        self.lock = threading.Lock()
+
+
+def player_id_for(shorturl: str, fs_id: str) -> str:
+    """Stable player ID for a file in a share"""
+    return hashlib.sha256(f"{shorturl}:{fs_id}".encode()).hexdigest()[:16]
+
+
+def register_player(shorturl: str, pwd: str, fs_id: str, url: str) -> str:
+    """Remember the share identity for a file and return its player ID
+
+    Callers must have verified the identity's signature, entries are trusted
+    as-is and an existing entry keeps its (possibly renewed) link.
+    """
+    player_id = player_id_for(shorturl, fs_id)
+    
+    with players_lock:
+        if player_id not in players:
+            players[player_id] = Player(shorturl, pwd, fs_id, url)
+        players.move_to_end(player_id)
+        
+        while len(players) > PLAYER_CACHE_SIZE:
+            players.popitem(last=False)
+    
+    return player_id
+
+
+def register_signed_player() -> str:
+    """Register the share identity in the query string if the bot signed it"""
+    encoded_url = request.args.get('v', '')
+    shorturl = request.args.get('s')
+    pwd = request.args.get('p', '')
+    fs_id = request.args.get('f')
+    
+    if not shorturl or not fs_id:
+        return None
+    
+    if not verify(request.args.get('sig'), encoded_url, shorturl, pwd, fs_id):
+        return None
+    
+    video_url = decode_url(encoded_url)
+    
+    if not video_url:
+        return None
+    
+    return register_player(shorturl, pwd, fs_id, video_url)
+
+
+def get_player(player_id: str) -> Player:
+    """Look up a registered player"""
+    with players_lock:
+        player = players.get(player_id)
+        if player:
+            players.move_to_end(player_id)
+        return player
+
+
+def refresh_player_link(player: Player, expired_url: str) -> str:
+    """Re-resolve an expired download link, once for all streams that hit it"""
+    with player.lock:
+        # Another stream already renewed it while we waited
+        if player.url != expired_url:
+            return player.url
+        
+        if time.monotonic() - player.failed_at < REFRESH_COOLDOWN:
+            return None
+        
+        url = resolve_download_link(player.shorturl, player.pwd, player.fs_id)
+        
+        with players_lock:
+            link_refreshes['ok' if url else 'failed'] += 1
+        
+        if url:
+            player.url = url
+        else:
+            player.failed_at = time.monotonic()
+        
+        return url
+
+
 @app.route('/')
 def index():
     """Home page"""
@@ -399,13 +565,32 @@ def player():
         # Decode filename if URL encoded
         filename = unquote(filename)
         
-        # Generate a unique ID for this video (for localStorage)
-        video_id = abs(hash(video_url)) % (10 ** 8)
+        # Signed share identity, lets the server renew the link when it expires
+        player_id = register_signed_player()
+        
+        # Only links signed by the bot are served through our proxy,
+        # anything else plays straight from the CDN
+        if player_id:
+            video_id = player_id
+            # Carry the signed identity so the stream survives a server restart
+            stream_url = url_for(
+                'stream',
+                player_id=player_id,
+                v=encoded_url,
+                s=request.args['s'],
+                p=request.args.get('p', ''),
+                f=request.args['f'],
+                sig=request.args['sig']
+            )
+        else:
+            # Generate a unique ID for this video (for localStorage)
+            video_id = abs(hash(video_url)) % (10 ** 8)
+            stream_url = video_url
         
         # Render the player template
         return render_template_string(
             PLAYER_TEMPLATE,
-            video_url=video_url,
+            video_url=stream_url,
             filename=filename,
             video_id=video_id
         )
@@ -417,6 +602,175 @@ def player():
         ), 500
 
 
+def get_client_id() -> str:
+    """Identify the client for per-client limits"""
+    return request.remote_addr or 'unknown'
+
+
+def check_admin():
+    """Abort unless the request carries the admin token"""
+    if not ADMIN_TOKEN:
+        abort(404)
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        abort(403)
+
+
+def parse_range(header: str) -> tuple:
+    """Parse a single `bytes=start-end` Range header into (start, end) or None"""
+    match = re.fullmatch(r'bytes=(\d+)-(\d*)', (header or '').strip())
+    
+    if not match:
+        # No range, or one we don't support (suffix, multiple ranges): send everything
+        return None
+    
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else None
+    
+    if end is not None and end < start:
+        return None
+    
+    return start, end
+
+
+@app.route('/stream/<player_id>')
+def stream(player_id: str):
+    """Proxy the video from the CDN with bandwidth shaping"""
+    player = get_player(player_id)
+    
+    # Registry was lost (e.g. restart), rebuild it from the signed identity
+    if not player and register_signed_player() == player_id:
+        player = get_player(player_id)
+    
+    if not player:
+        return {'error': 'Unknown player, please reopen the player link'}, 404
+    
+    video_url = player.url
+    
+    if not video_url or not video_url.startswith(('http://', 'https://')):
+        return {'error': 'Invalid video URL'}, 400
+    
+    # Shed load before opening an upstream connection
+    ticket, retry_after = scheduler.admit(get_client_id())
+    
+    if ticket is None:
+        return Response(
+            'Server is busy, please retry later.\n',
+            status=503,
+            headers={'Retry-After': str(retry_after)},
+            mimetype='text/plain'
+        )
+    
+    byte_range = parse_range(request.headers.get('Range'))
+    start, end = byte_range or (0, None)
+    
+    # Fetch the requested range over several CDN connections at once
+    upstream = SegmentedFetcher(
+        video_url, start, end,
+        headers=UPSTREAM_HEADERS,
+        segment_size=STREAM_SEGMENT_SIZE,
+        buffer_size=STREAM_BUFFER_SIZE,
+        max_connections=STREAM_MAX_CONNECTIONS,
+        refresh=functools.partial(refresh_player_link, player)
+    )
+    
+    try:
+        upstream.open()
+    except FetchError as e:
+        scheduler.release(ticket)
+        if e.status_code == 503:
+            # Out of upstream connections
+            return Response(
+                'Server is busy, please retry later.\n',
+                status=503,
+                headers={'Retry-After': str(scheduler.settings['retry_after'])},
+                mimetype='text/plain'
+            )
+        if e.status_code == 416:
+            # Tell the player the real size so it can ask for a valid range
+            headers = {}
+            if 'Content-Range' in upstream.response_headers:
+                headers['Content-Range'] = upstream.response_headers['Content-Range']
+            return Response(status=416, headers=headers)
+        return {'error': str(e)}, e.status_code or 502
+    except Exception as e:
+        scheduler.release(ticket)
+        return {'error': f'Upstream request failed: {e}'}, 502
+    
+    def generate():
+        for chunk in upstream.iter_content(chunk_size=scheduler.settings['chunk_size']):
+            scheduler.acquire(ticket, len(chunk))
+            yield chunk
+    
+    def cleanup():
+        upstream.close()
+        scheduler.release(ticket)
+    
+    response_headers = {
+        name: upstream.response_headers[name]
+        for name in PASSTHROUGH_HEADERS
+        if name in upstream.response_headers
+    }
+    status = 200
+    
+    if upstream.ranged:
+        response_headers['Accept-Ranges'] = 'bytes'
+        response_headers['Content-Length'] = str(upstream.end - upstream.start + 1)
+        if byte_range:
+            status = 206
+            response_headers['Content-Range'] = f"bytes {upstream.start}-{upstream.end}/{upstream.size}"
+    elif upstream.size is not None:
+        response_headers['Content-Length'] = str(upstream.size)
+    
+    response = Response(
+        stream_with_context(generate()),
+        status=status,
+        headers=response_headers
+    )
+    # Runs when the client finishes or disconnects, even if the body was never read
+    response.call_on_close(cleanup)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics endpoint"""
+    with players_lock:
+        lines = [
+            '# HELP terabox_link_refreshes_total Expired download links re-resolved.',
+            '# TYPE terabox_link_refreshes_total counter',
+        ]
+        lines += [
+            f'terabox_link_refreshes_total{{result="{result}"}} {count}'
+            for result, count in link_refreshes.items()
+        ]
+        lines += [
+            '# HELP terabox_players Players with a remembered share identity.',
+            '# TYPE terabox_players gauge',
+            f'terabox_players {len(players)}',
+        ]
+    
+    return Response(scheduler.metrics() + '\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/throttle', methods=['GET', 'POST'])
+def admin_throttle():
+    """View or change bandwidth shaping settings at runtime"""
+    check_admin()
+    
+    if request.method == 'GET':
+        return jsonify(scheduler.snapshot_settings())
+    
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict):
+        return {'error': 'Expected a JSON object'}, 400
+    
+    try:
+        return jsonify(scheduler.configure(changes))
+    except (TypeError, ValueError) as e:
+        return {'error': str(e)}, 400
+
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
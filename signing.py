@@ -0,0 +1,23 @@
+import os
+import hmac
+import json
+import hashlib
+
+# Secret shared by the bot and the server. The server only proxies links
+# signed with it, so it never fetches URLs it was not handed by the bot.
+LINK_SECRET = os.getenv("LINK_SECRET", "")
+
+
+def sign(*parts) -> str:
+    """Sign link parameters, returns '' when no secret is configured"""
+    if not LINK_SECRET:
+        return ''
+    message = json.dumps([str(part) for part in parts]).encode()
+    return hmac.new(LINK_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+
+def verify(signature: str, *parts) -> bool:
+    """Check a signature produced by sign()"""
+    if not LINK_SECRET or not signature:
+        return False
+    return hmac.compare_digest(signature, sign(*parts))
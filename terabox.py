@@ -0,0 +1,115 @@
+import logging
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Terabox API endpoints
+TERABOX_API_BASE = "https://terabox.hnn.workers.dev/api"
+INFO_ENDPOINT = f"{TERABOX_API_BASE}/get-info-new"
+DOWNLOAD_ENDPOINT = f"{TERABOX_API_BASE}/get-downloadp"
+
+# Headers for requests
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/144.0.0.0 Safari/537.36 Edg/144.0.0.0',
+    'accept-language': 'en-US,en;q=0.9',
+    'cache-control': 'no-cache',
+    'pragma': 'no-cache',
+    'priority': 'u=1, i',
+    'referer': 'https://terabox.hnn.workers.dev/',
+    'sec-ch-ua': '"Not(A:Brand";v="8", "Chromium";v="144", "Microsoft Edge";v="144"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-origin',
+    'sec-fetch-storage-access': 'active'
+}
+
+
+def get_terabox_info(shorturl: str, pwd: str = '') -> dict:
+    """Get file info from Terabox API"""
+    try:
+        params = {
+            'shorturl': shorturl,
+            'pwd': pwd
+        }
+        
+        response = requests.get(INFO_ENDPOINT, params=params, headers=HEADERS, timeout=30)
+        response.raise_for_status()
+        
+        data = response.json()
+        
+        if data.get('ok'):
+            return data
+        else:
+            logger.error(f"API returned not ok: {data}")
+            return None
+            
+    except Exception as e:
+        logger.error(f"Error getting Terabox info: {e}")
+        return None
+
+
+def get_download_link(shareid: int, uk: int, sign: str, timestamp: int, fs_id: str) -> dict:
+    """Get download link from Terabox API"""
+    try:
+        payload = {
+            'shareid': shareid,
+            'uk': uk,
+            'sign': sign,
+            'timestamp': timestamp,
+            'fs_id': fs_id
+        }
+        
+        headers = HEADERS.copy()
+        headers['Content-Type'] = 'application/json'
+        headers['origin'] = 'https://terabox.hnn.workers.dev'
+        
+        response = requests.post(
+            DOWNLOAD_ENDPOINT, 
+            json=payload, 
+            headers=headers,
+            timeout=30
+        )
+        response.raise_for_status()
+        
+        data = response.json()
+        
+        if data.get('ok'):
+            return data
+        else:
+            logger.error(f"Download API returned not ok: {data}")
+            return None
+            
+    except Exception as e:
+        logger.error(f"Error getting download link: {e}")
+        return None
+
+
+def resolve_download_link(shorturl: str, pwd: str, fs_id: str) -> str:
+    """Resolve a fresh download link for a file in a share"""
+    # fs_id comes back from a query string, the API wants it as a number
+    try:
+        fs_id = int(fs_id)
+    except (TypeError, ValueError):
+        logger.error(f"Invalid fs_id: {fs_id!r}")
+        return None
+    
+    info_data = get_terabox_info(shorturl, pwd)
+    
+    if not info_data:
+        return None
+    
+    download_data = get_download_link(
+        shareid=info_data.get('shareid'),
+        uk=info_data.get('uk'),
+        sign=info_data.get('sign'),
+        timestamp=info_data.get('timestamp'),
+        fs_id=fs_id
+    )
+    
+    if not download_data:
+        return None
+    
+    return download_data.get('downloadLink')
@@ -0,0 +1,333 @@
+import os
+import math
+import time
+import heapq
+import itertools
+import threading
+
+
+def _env_float(name: str, default: float) -> float:
+    """Read a float from the environment"""
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return float(default)
+
+
+def _number(name: str, value) -> float:
+    """Validate a numeric setting"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{name} must be a number")
+    try:
+        value = float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number")
+    if not math.isfinite(value):
+        raise ValueError(f"{name} must be finite")
+    return value
+
+
+# Tunables, all of which can be changed at runtime through Scheduler.configure().
+# Rates are in bytes per second, 0 means unlimited.
+DEFAULT_SETTINGS = {
+    'global_rate': _env_float('GLOBAL_RATE_LIMIT', 0),
+    'global_burst': _env_float('GLOBAL_BURST', 4 * 1024 * 1024),
+    'client_rate': _env_float('CLIENT_RATE_LIMIT', 0),
+    'client_burst': _env_float('CLIENT_BURST', 2 * 1024 * 1024),
+    'max_streams': int(_env_float('MAX_STREAMS', 0)),
+    'max_client_streams': int(_env_float('MAX_CLIENT_STREAMS', 0)),
+    'shed_queue_delay': _env_float('SHED_QUEUE_DELAY', 5),
+    'retry_after': int(_env_float('RETRY_AFTER', 5)),
+    'chunk_size': int(_env_float('STREAM_CHUNK_SIZE', 64 * 1024)),
+    'default_weight': _env_float('DEFAULT_CLIENT_WEIGHT', 1),
+    'weights': {},
+}
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations and lets the balance go negative"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: int) -> float:
+        """Take `amount` tokens and return how long the caller must wait for them"""
+        with self.lock:
+            if self.rate <= 0:
+                return 0.0
+            self._refill(time.monotonic())
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def try_take(self, amount: int) -> float:
+        """Take `amount` tokens if available, otherwise return how long until they are"""
+        with self.lock:
+            if self.rate <= 0:
+                return 0.0
+            self._refill(time.monotonic())
+            # Chunks larger than the burst are let through once the bucket is full
+            needed = min(amount, self.burst)
+            if self.tokens >= needed:
+                self.tokens -= amount
+                return 0.0
+            return (needed - self.tokens) / self.rate
+
+    def backlog(self) -> float:
+        """Seconds until the bucket is out of debt"""
+        with self.lock:
+            if self.rate <= 0:
+                return 0.0
+            self._refill(time.monotonic())
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def configure(self, rate: float, burst: float):
+        """Change rate and burst without dropping the current balance"""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+
+
+class Client:
+    """Per-client state shared by all of its streams"""
+
+    def __init__(self, client_id: str, rate: float, burst: float):
+        self.client_id = client_id
+        self.bucket = TokenBucket(rate, burst)
+        self.streams = 0
+        self.bytes_sent = 0
+
+
+class Stream:
+    """Admission ticket for a single response body"""
+
+    def __init__(self, client: Client):
+        self.client = client
+        self.finish = 0.0
+        self.bytes_sent = 0
+        self.started = time.monotonic()
+
+
+class Scheduler:
+    """Bandwidth shaping and weighted fair scheduling of chunk writes
+
+    Every chunk passes the client's token bucket (per-client cap) and then
+    queues for the global bucket. The global queue is served in order of
+    weighted virtual finish time, where a client's weight is split evenly
+    across its active streams, so opening many parallel ranges does not buy
+    a client a bigger share of the egress.
+    """
+
+    def __init__(self, settings: dict = None):
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings['weights'] = dict(DEFAULT_SETTINGS['weights'])
+        self.cond = threading.Condition()
+        self.clients = {}
+        self.queue = []
+        self.queued_bytes = 0
+        self.sequence = itertools.count()
+        self.virtual_time = 0.0
+        self.global_bucket = TokenBucket(self.settings['global_rate'], self.settings['global_burst'])
+
+        # Metrics
+        self.bytes_total = 0
+        self.streams_total = 0
+        self.shed_total = {'streams': 0, 'client_streams': 0, 'saturated': 0}
+        self.wait_seconds_total = 0.0
+        self.egress_rate = 0.0
+        self.egress_updated = time.monotonic()
+
+        if settings:
+            self.configure(settings)
+
+    def configure(self, changes: dict) -> dict:
+        """Validate and apply new settings, returning the full settings"""
+        with self.cond:
+            updated = dict(self.settings)
+            for key, value in changes.items():
+                if key not in DEFAULT_SETTINGS:
+                    raise ValueError(f"Unknown setting: {key}")
+                if key == 'weights':
+                    if not isinstance(value, dict):
+                        raise ValueError("weights must be an object of client -> weight")
+                    weights = {str(k): _number(f"weight for {k}", v) for k, v in value.items()}
+                    if any(w <= 0 for w in weights.values()):
+                        raise ValueError("weights must be positive")
+                    updated[key] = weights
+                    continue
+                value = _number(key, value)
+                if isinstance(DEFAULT_SETTINGS[key], int):
+                    if not value.is_integer():
+                        raise ValueError(f"{key} must be a whole number")
+                    value = int(value)
+                if value < 0 or (key in ('chunk_size', 'default_weight') and value == 0):
+                    raise ValueError(f"Invalid value for {key}: {value}")
+                updated[key] = value
+
+            self.settings = updated
+            self.global_bucket.configure(updated['global_rate'], updated['global_burst'])
+            for client in self.clients.values():
+                client.bucket.configure(updated['client_rate'], updated['client_burst'])
+            self.cond.notify_all()
+            return self.snapshot_settings()
+
+    def snapshot_settings(self) -> dict:
+        """Copy of the current settings"""
+        settings = dict(self.settings)
+        settings['weights'] = dict(settings['weights'])
+        return settings
+
+    def admit(self, client_id: str) -> tuple:
+        """Admit a new stream, returning (stream, None) or (None, retry_after)"""
+        with self.cond:
+            settings = self.settings
+            self._prune()
+            active = sum(c.streams for c in self.clients.values())
+            client = self.clients.get(client_id)
+
+            reason = None
+            if settings['max_streams'] and active >= settings['max_streams']:
+                reason = 'streams'
+            elif settings['max_client_streams'] and client and client.streams >= settings['max_client_streams']:
+                reason = 'client_streams'
+            elif self._queue_delay() > settings['shed_queue_delay']:
+                reason = 'saturated'
+
+            if reason:
+                self.shed_total[reason] += 1
+                retry_after = settings['retry_after']
+                if reason == 'saturated':
+                    retry_after = max(retry_after, math.ceil(self._queue_delay()))
+                return None, retry_after
+
+            if client is None:
+                client = Client(client_id, settings['client_rate'], settings['client_burst'])
+                self.clients[client_id] = client
+            client.streams += 1
+            self.streams_total += 1
+            return Stream(client), None
+
+    def release(self, stream: Stream):
+        """Mark a stream as finished"""
+        with self.cond:
+            client = stream.client
+            client.streams -= 1
+            self._prune()
+            self.cond.notify_all()
+
+    def _prune(self):
+        # Idle clients are kept while they still owe tokens so that reconnecting
+        # does not reset their per-client cap
+        for client_id, client in list(self.clients.items()):
+            if client.streams <= 0 and client.bucket.backlog() == 0:
+                del self.clients[client_id]
+
+    def _weight(self, client: Client) -> float:
+        weight = self.settings['weights'].get(client.client_id, self.settings['default_weight'])
+        return weight / max(client.streams, 1)
+
+    def _queue_delay(self) -> float:
+        # Time needed to drain the chunks waiting for the global bucket
+        rate = self.settings['global_rate']
+        return self.queued_bytes / rate if rate > 0 else 0.0
+
+    def acquire(self, stream: Stream, amount: int):
+        """Block until `amount` bytes may be written for this stream"""
+        started = time.monotonic()
+        delay = stream.client.bucket.reserve(amount)
+        if delay:
+            time.sleep(delay)
+
+        with self.cond:
+            if self.settings['global_rate'] > 0:
+                tag = max(self.virtual_time, stream.finish) + amount / self._weight(stream.client)
+                stream.finish = tag
+                entry = (tag, next(self.sequence))
+                heapq.heappush(self.queue, entry)
+                self.queued_bytes += amount
+
+                # Only the entry with the smallest finish tag may take tokens,
+                # everyone else waits behind it
+                while True:
+                    if self.queue[0] == entry:
+                        delay = self.global_bucket.try_take(amount)
+                        if not delay:
+                            break
+                        self.cond.wait(delay)
+                    else:
+                        self.cond.wait()
+
+                heapq.heappop(self.queue)
+                self.queued_bytes -= amount
+                self.virtual_time = tag
+                self.cond.notify_all()
+
+            self._record(stream, amount, time.monotonic() - started)
+
+    def _record(self, stream: Stream, amount: int, waited: float):
+        now = time.monotonic()
+        elapsed = now - self.egress_updated
+        # Exponentially weighted egress rate with a ~5s time constant
+        decay = math.exp(-elapsed / 5.0) if elapsed > 0 else 1.0
+        self.egress_rate = self.egress_rate * decay + amount / 5.0
+        self.egress_updated = now
+
+        stream.bytes_sent += amount
+        stream.client.bytes_sent += amount
+        self.bytes_total += amount
+        self.wait_seconds_total += waited
+
+    def metrics(self) -> str:
+        """Render metrics in the Prometheus text exposition format"""
+        with self.cond:
+            elapsed = time.monotonic() - self.egress_updated
+            egress = self.egress_rate * math.exp(-elapsed / 5.0)
+            lines = [
+                '# HELP terabox_stream_bytes_total Bytes written to streaming clients.',
+                '# TYPE terabox_stream_bytes_total counter',
+                f'terabox_stream_bytes_total {self.bytes_total}',
+                '# HELP terabox_streams_total Streams admitted.',
+                '# TYPE terabox_streams_total counter',
+                f'terabox_streams_total {self.streams_total}',
+                '# HELP terabox_streams_active Streams currently being served.',
+                '# TYPE terabox_streams_active gauge',
+                f'terabox_streams_active {sum(c.streams for c in self.clients.values())}',
+                '# HELP terabox_clients_active Clients with at least one active stream.',
+                '# TYPE terabox_clients_active gauge',
+                f'terabox_clients_active {sum(1 for c in self.clients.values() if c.streams)}',
+                '# HELP terabox_streams_shed_total Streams rejected with 503.',
+                '# TYPE terabox_streams_shed_total counter',
+            ]
+            lines += [
+                f'terabox_streams_shed_total{{reason="{reason}"}} {count}'
+                for reason, count in self.shed_total.items()
+            ]
+            lines += [
+                '# HELP terabox_throttle_wait_seconds_total Time spent waiting on rate limits.',
+                '# TYPE terabox_throttle_wait_seconds_total counter',
+                f'terabox_throttle_wait_seconds_total {self.wait_seconds_total:.3f}',
+                '# HELP terabox_egress_bytes_per_second Smoothed egress rate.',
+                '# TYPE terabox_egress_bytes_per_second gauge',
+                f'terabox_egress_bytes_per_second {egress:.1f}',
+                '# HELP terabox_egress_queue_seconds Time to drain chunks queued for the global rate.',
+                '# TYPE terabox_egress_queue_seconds gauge',
+                f'terabox_egress_queue_seconds {self._queue_delay():.3f}',
+                '# HELP terabox_throttle_setting Current shaping settings.',
+                '# TYPE terabox_throttle_setting gauge',
+            ]
+            lines += [
+                f'terabox_throttle_setting{{name="{key}"}} {value}'
+                for key, value in self.settings.items()
+                if key != 'weights'
+            ]
+            return '\n'.join(lines) + '\n'